@@ -1,120 +1,273 @@
 # Standard library imports
-from datetime import datetime, timezone, timedelta
+from datetime import datetime
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
 import os
-import json
-from functools import wraps
-from typing import Optional, Dict, Any
+import hmac
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from typing import Optional, Dict, Any, Union
+from zoneinfo import ZoneInfo
 
 # Third party imports
 from flask import Flask, jsonify, request, render_template, session, redirect, url_for
-from flask_cors import CORS
+from flask.json.provider import JSONProvider
 import requests
-import pytz
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+import orjson
 
 # Load environment variables
 load_dotenv()
 
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Environment-driven settings, read and validated once at startup"""
+    sensibo_key: str
+    device_id: str
+    min_temp: int
+    default_temp: int
+    klasse: str
+
+    def __post_init__(self) -> None:
+        if not self.sensibo_key or not self.device_id:
+            raise ValueError("SENSIBO_API_KEY and SENSIBO_DEVICE_ID must be set")
+        if self.klasse not in ('SE1', 'SE2', 'SE3', 'SE4'):
+            raise ValueError(f"Invalid PRIS_KLASSE: {self.klasse}")
+
 # Configuration constants
-SENSIBO_API_KEY = os.getenv('SENSIBO_API_KEY')
-SENSIBO_DEVICE_ID = os.getenv('SENSIBO_DEVICE_ID')
+CFG = Config(
+    sensibo_key=os.getenv('SENSIBO_API_KEY', ''),
+    device_id=os.getenv('SENSIBO_DEVICE_ID', ''),
+    min_temp=int(os.getenv('MIN_TEMP', 10)),
+    default_temp=int(os.getenv('DEFAULT_TEMP', 22)),
+    klasse=os.getenv('PRIS_KLASSE', 'SE3')
+)
 SENSIBO_API_BASE = "https://home.sensibo.com/api/v2"
-PRIS_KLASSE = os.getenv('PRIS_KLASSE', 'SE3')
-MIN_TEMP = int(os.getenv('MIN_TEMP', 10))
-DEFAULT_TEMP = int(os.getenv('DEFAULT_TEMP', 22))
+ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', '').encode()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 THRESHOLD_FILE = 'threshold.json'
+CONTROL_STAMP_FILE = 'control.stamp'  # generation of the latest heat pump command, shared by workers
+CET = ZoneInfo('Europe/Stockholm')
+PRICE_CACHE_TTL = 3600  # seconds; a day's price list does not change once published
+PRICE_CACHE_MAXSIZE = 8
+HEAT_PUMP_MAX_RETRIES = 3
+HEAT_PUMP_RETRY_DELAY = 30  # seconds
+SENSIBO_DEBOUNCE_SECONDS = 60
+SENSIBO_TIMEOUT = (3, 8)  # (connect, read) seconds
+
+# Sensibo request parts are fixed for the life of the process, so build them once
+SENSIBO_URL = f"{SENSIBO_API_BASE}/pods/{CFG.device_id}/acStates"
+SENSIBO_PARAMS = {'apiKey': CFG.sensibo_key}
+PAYLOAD_ON = orjson.dumps({
+    'acState': {
+        'on': True,
+        'targetTemperature': CFG.default_temp,
+        'mode': 'heat',
+        'fanLevel': 'auto',
+        'swing': 'stopped'
+    }
+})
+PAYLOAD_OFF = orjson.dumps({
+    'acState': {
+        'on': False,
+        'targetTemperature': CFG.min_temp,
+        'mode': 'fan',
+        'fanLevel': 'auto',
+        'swing': 'stopped'
+    }
+})
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
 
 # Configure Flask app
 app = Flask(__name__)
-CORS(app)
+app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', os.urandom(24))
 app.config['SESSION_COOKIE_SECURE'] = False
 
+# Shared HTTP session so Sensibo and elprisetjustnu calls reuse pooled connections
+HTTP = requests.Session()
+HTTP.headers.update({
+    'Accept': 'application/json',
+    'Content-Type': 'application/json'
+})
+HTTP.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=10,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+))
+# The acState POST sets an absolute state, so connect and 5xx failures are safe to
+# retry; read timeouts are not, as each one would hold _sensibo_lock for another read
+HTTP.mount('https://home.sensibo.com/', HTTPAdapter(
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=2,
+        read=0,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'}
+    )
+))
+
 # Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s: %(message)s',
-    handlers=[logging.StreamHandler(), logging.FileHandler('app.log')]
-)
+# Request threads only enqueue records; a background listener formats and writes them
+_log_formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+_log_stream_handler = logging.StreamHandler()
+# Every gunicorn worker appends to app.log, so rotation is left to logrotate;
+# WatchedFileHandler reopens the file once it has been moved away
+_log_file_handler = WatchedFileHandler('app.log')
+for _handler in (_log_stream_handler, _log_file_handler):
+    _handler.setFormatter(_log_formatter)
+
+_log_queue_handler = QueueHandler(queue.Queue(-1))
+_log_listener = None
+
+def _start_log_listener() -> None:
+    """Start the background log writer for this process"""
+    global _log_listener
+    _log_listener = QueueListener(_log_queue_handler.queue, _log_stream_handler, _log_file_handler)
+    _log_listener.start()
+
+def _restart_log_listener_after_fork() -> None:
+    """Threads do not survive fork (gunicorn --preload), so give each worker its own listener"""
+    _log_queue_handler.queue = queue.Queue(-1)
+    _start_log_listener()
+
+_start_log_listener()
+atexit.register(lambda: _log_listener.stop())
+os.register_at_fork(after_in_child=_restart_log_listener_after_fork)
+
+# Records are fully formatted by the listener's handlers, so only merge the message here
+logging.basicConfig(level=LOG_LEVEL, format='%(message)s', handlers=[_log_queue_handler])
 logger = logging.getLogger(__name__)
 
 # Helper functions
 def get_cet_time() -> datetime:
     """Get current time in CET/CEST timezone"""
+    return datetime.now(CET)
+
+# Parsed threshold, re-read only when the file's mtime changes
+_threshold_cache = {'mtime': None, 'value': 5.0}
+_threshold_lock = threading.Lock()
+
+def _read_threshold() -> float:
+    """Read the threshold, re-parsing only if the file changed; caller must hold _threshold_lock"""
     try:
-        utc_now = datetime.now(timezone.utc)
-        cet_tz = pytz.timezone('Europe/Stockholm')
-        return utc_now.astimezone(cet_tz)
-    except Exception as e:
-        logger.error(f"Error getting CET time: {e}")
-        return datetime.now()
+        mtime = os.stat(THRESHOLD_FILE).st_mtime
+    except FileNotFoundError:
+        return 5.0
+    if mtime == _threshold_cache['mtime']:
+        return _threshold_cache['value']
+
+    with open(THRESHOLD_FILE, 'rb') as f:
+        data = orjson.loads(f.read())
+    value = data.get("price_threshold", 5.0)
+    _threshold_cache.update(mtime=mtime, value=value)
+    return value
 
 def load_threshold() -> float:
     """Load price threshold from file"""
     try:
-        if os.path.exists(THRESHOLD_FILE):
-            with open(THRESHOLD_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get("price_threshold", 5.0)
-        else:
-            return 5.0
+        with _threshold_lock:
+            return _read_threshold()
     except Exception as e:
         logger.error(f"Error loading threshold: {e}")
         return 5.0
 
-def save_threshold(price_threshold: float) -> None:
+def save_threshold(price_threshold: float) -> bool:
     """Save price threshold to file"""
     try:
         threshold = {"price_threshold": price_threshold}
-        with open(THRESHOLD_FILE, 'w') as f:
-            json.dump(threshold, f)
+        threshold_dir = os.path.dirname(os.path.abspath(THRESHOLD_FILE))
+        with _threshold_lock:
+            try:
+                current = _read_threshold()
+            except (OSError, ValueError, AttributeError) as e:
+                # A damaged file must not block the write that repairs it
+                logger.warning(f"Existing threshold file unreadable, overwriting: {e}")
+                current = None
+            if price_threshold == current:
+                logger.debug("Threshold unchanged, skipping write.")
+                return True
+
+            # mkstemp creates the file as 0600; keep the existing file's mode instead
+            try:
+                mode = os.stat(THRESHOLD_FILE).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+
+            # Write to a temp file and swap it in so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=threshold_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(orjson.dumps(threshold))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmp_path, mode)
+                os.replace(tmp_path, THRESHOLD_FILE)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            _threshold_cache.update(mtime=os.stat(THRESHOLD_FILE).st_mtime, value=price_threshold)
         logger.info("Threshold saved successfully.")
+        return True
     except Exception as e:
         logger.error(f"Error saving threshold: {e}")
+        return False
 
-def control_heat_pump(turn_on: bool) -> bool:
-    """Control the heat pump via Sensibo API."""
+# Last state successfully sent to Sensibo, used to skip repeated identical commands.
+# The lock is held across the POST so the check and the update cannot interleave.
+_last_state = {'turn_on': None, 'ts': 0.0}
+_sensibo_lock = threading.Lock()
+
+def control_heat_pump(turn_on: bool, force: bool = False, generation: Optional[str] = None) -> bool:
+    """Control the heat pump via Sensibo API.
+
+    Repeats of the last successful command within SENSIBO_DEBOUNCE_SECONDS are
+    skipped unless force is set, e.g. for manual commands from the dashboard.
+    Background commands pass their generation and are dropped once superseded.
+    """
+    with _sensibo_lock:
+        if generation is not None and _is_superseded(generation):
+            logger.info("Skipping superseded heat pump command")
+            return True
+        if (not force and _last_state['turn_on'] == turn_on
+                and time.monotonic() - _last_state['ts'] < SENSIBO_DEBOUNCE_SECONDS):
+            logger.debug("Heat pump already %s, skipping Sensibo call", 'on' if turn_on else 'off')
+            return True
+        return _send_heat_pump_state(turn_on)
+
+def _send_heat_pump_state(turn_on: bool) -> bool:
+    """POST the on/off state to Sensibo; caller must hold _sensibo_lock."""
     try:
-        if not SENSIBO_API_KEY or not SENSIBO_DEVICE_ID:
-            logger.error("Missing Sensibo API credentials")
-            return False
-
-        url = f"{SENSIBO_API_BASE}/pods/{SENSIBO_DEVICE_ID}/acStates"
-        headers = {
-            'Accept': 'application/json',
-            'Content-Type': 'application/json'
-        }
-        params = {'apiKey': SENSIBO_API_KEY}
-
-        # Increase timeout and add retries for reliability
-        session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=2)
-        session.mount('https://', adapter)
+        logger.debug("Sending request to Sensibo API: %s", SENSIBO_URL)
         
-        # Build payload
-        payload = {
-            'acState': {
-                'on': turn_on,
-                'targetTemperature': DEFAULT_TEMP if turn_on else MIN_TEMP,
-                'mode': 'heat' if turn_on else 'fan',
-                'fanLevel': 'auto',
-                'swing': 'stopped'
-            }
-        }
-
-        logger.debug(f"Sending request to Sensibo API: {url}")
-        
-        # Increased timeout to 30 seconds
-        response = session.post(
-            url, 
-            headers=headers,
-            params=params, 
-            json=payload,
-            timeout=30
+        # Short connect/read timeouts; connect and 5xx failures are retried, a read timeout is not
+        response = HTTP.post(
+            SENSIBO_URL,
+            params=SENSIBO_PARAMS,
+            data=PAYLOAD_ON if turn_on else PAYLOAD_OFF,
+            timeout=SENSIBO_TIMEOUT
         )
         
         response.raise_for_status()
+        _last_state.update(turn_on=turn_on, ts=time.monotonic())
         logger.info(f"Heat pump turned {'on' if turn_on else 'off'}.")
         return True
         
@@ -131,18 +284,76 @@ def control_heat_pump(turn_on: bool) -> bool:
         logger.error(f"Unexpected error controlling heat pump: {str(e)}")
         return False
 
-def check_price_and_control_heat_pump(current_price: float) -> None:
-    """Check the current price against the threshold and control the heat pump."""
-    price_threshold = load_threshold()
+# Single background worker so price-driven Sensibo calls never block a request thread.
+# Only the latest desired state is kept pending. Every new command, automatic or
+# manual, writes a fresh generation to CONTROL_STAMP_FILE, so older queued or
+# retrying commands in any gunicorn worker are dropped instead of overriding it.
+# The POST itself is only serialized within one worker, so two workers can still
+# send at the same moment; the later stamp wins on the next retry or poll.
+_control_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='heat-pump')
+_control_state = {'pending': None}
+_control_lock = threading.Lock()
+
+def _new_control_generation() -> str:
+    """Record a new command generation where all workers can see it"""
+    generation = uuid.uuid4().hex
+    stamp_dir = os.path.dirname(os.path.abspath(CONTROL_STAMP_FILE))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=stamp_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(generation)
+            os.replace(tmp_path, CONTROL_STAMP_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logger.warning(f"Could not write control stamp: {e}")
+    return generation
+
+def _is_superseded(generation: str) -> bool:
+    try:
+        with open(CONTROL_STAMP_FILE, 'r') as f:
+            return f.read() != generation
+    except OSError as e:
+        # Without a readable stamp, let the command through rather than stall control
+        logger.warning(f"Could not read control stamp: {e}")
+        return False
+
+def control_heat_pump_task(turn_on: bool, generation: str) -> None:
+    """Control the heat pump in the background, retrying on failure."""
+    for attempt in range(1, HEAT_PUMP_MAX_RETRIES + 1):
+        if _is_superseded(generation):
+            logger.info("Heat pump command superseded by a newer one")
+            return
+        if control_heat_pump(turn_on, generation=generation):
+            return
+        if attempt < HEAT_PUMP_MAX_RETRIES:
+            logger.warning(f"Heat pump command failed, retrying in {HEAT_PUMP_RETRY_DELAY}s "
+                           f"(attempt {attempt}/{HEAT_PUMP_MAX_RETRIES})")
+            time.sleep(HEAT_PUMP_RETRY_DELAY)
+    logger.error(f"Giving up on turning heat pump {'on' if turn_on else 'off'}")
+
+def _run_pending_control() -> None:
+    with _control_lock:
+        turn_on, generation = _control_state['pending']
+        _control_state['pending'] = None
+    control_heat_pump_task(turn_on, generation)
 
-    if price_threshold is None:
-        logger.error("Invalid threshold price")
-        return
+def schedule_heat_pump_control(current_price: float) -> None:
+    """Queue a price-driven heat pump update without waiting for Sensibo."""
+    turn_on = current_price <= load_threshold()
+    with _control_lock:
+        generation = _new_control_generation()
+        already_queued = _control_state['pending'] is not None
+        _control_state['pending'] = (turn_on, generation)
+    if not already_queued:
+        _control_executor.submit(_run_pending_control)
 
-    if current_price <= price_threshold:
-        control_heat_pump(True)
-    else:
-        control_heat_pump(False)
+def manual_heat_pump_control(turn_on: bool) -> bool:
+    """Send a dashboard command now, superseding any pending automatic command."""
+    _new_control_generation()
+    return control_heat_pump(turn_on, force=True)
 
 # Authentication decorator
 def login_required(func):
@@ -157,7 +368,8 @@ def login_required(func):
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        if request.form.get('password') == os.getenv('ADMIN_PASSWORD'):
+        entered = request.form.get('password', '').encode()
+        if ADMIN_PASSWORD and hmac.compare_digest(entered, ADMIN_PASSWORD):
             session['logged_in'] = True
             return redirect(url_for('index'))
         return render_template('login.html', error=True)
@@ -177,7 +389,7 @@ def strompris():
         # Fetch the current electricity price
         price = get_current_price()
         if price is not None:
-            check_price_and_control_heat_pump(price)
+            schedule_heat_pump_control(price)
             return jsonify({"pris": price})
         else:
             return jsonify({"error": "Failed to fetch electricity price"}), 500
@@ -202,7 +414,8 @@ def set_threshold():
         data = request.get_json()
         price_threshold = data.get('price_threshold')
         if price_threshold is not None:
-            save_threshold(price_threshold)
+            if not save_threshold(price_threshold):
+                return jsonify({"error": "Failed to save threshold"}), 500
             return jsonify({"status": "Threshold updated"})
         else:
             return jsonify({"error": "Invalid input"}), 400
@@ -214,7 +427,7 @@ def set_threshold():
 @login_required
 def turn_on():
     try:
-        success = control_heat_pump(True)
+        success = manual_heat_pump_control(True)
         if success:
             return jsonify({"status": "Heat pump turned on"})
         else:
@@ -227,7 +440,7 @@ def turn_on():
 @login_required
 def turn_off():
     try:
-        success = control_heat_pump(False)
+        success = manual_heat_pump_control(False)
         if success:
             return jsonify({"status": "Heat pump turned off"})
         else:
@@ -236,37 +449,86 @@ def turn_off():
         logger.error(f"Error turning off heat pump: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
-# Ensure this is part of your app.py
+# In-memory cache of day price lists: (år, måned, dag, klasse) -> (fetched_at, prices)
+_price_cache: Dict[tuple, tuple] = {}
+_price_cache_lock = threading.Lock()
+_price_fetch_lock = threading.Lock()
+_content_encoding_logged = threading.Event()
+
+@lru_cache(maxsize=4)
+def _price_url(år: int, måned: int, dag: int, klasse: str) -> str:
+    """Build the elprisetjustnu.se URL for one day's prices"""
+    return f"https://www.elprisetjustnu.se/api/v1/prices/{år}/{måned:02d}-{dag:02d}_{klasse}.json"
+
+def _fetch_day_prices(date_key: tuple) -> list:
+    """Download the price list for one day from elprisetjustnu.se"""
+    pris_url = _price_url(*date_key)
+    logger.debug("Fetching price from: %s", pris_url)
+
+    respons = HTTP.get(pris_url, timeout=10)
+    respons.raise_for_status()
+    if not _content_encoding_logged.is_set():
+        # Logged once per process to confirm the price API responds compressed
+        _content_encoding_logged.set()
+        logger.info("Price response Content-Encoding: %s", respons.headers.get('Content-Encoding'))
+    return orjson.loads(respons.content)
+
+def _cached_day_prices(date_key: tuple) -> tuple:
+    """Look up a day in the price cache, returning (entry, is_fresh)"""
+    with _price_cache_lock:
+        entry = _price_cache.get(date_key)
+    fresh = entry is not None and time.monotonic() - entry[0] < PRICE_CACHE_TTL
+    return entry, fresh
+
+def get_day_prices(date_key: tuple) -> list:
+    """Get the price list for one day, served from memory while fresh"""
+    entry, fresh = _cached_day_prices(date_key)
+    if fresh:
+        return entry[1]
+
+    # Only one thread downloads on a miss; the others wait and reuse its result
+    with _price_fetch_lock:
+        entry, fresh = _cached_day_prices(date_key)
+        if fresh:
+            return entry[1]
+
+        try:
+            prices = _fetch_day_prices(date_key)
+        except requests.exceptions.RequestException as e:
+            if entry is None:
+                raise
+            logger.warning(f"Price fetch failed, using cached prices: {e}")
+            return entry[1]
+
+        with _price_cache_lock:
+            _price_cache[date_key] = (time.monotonic(), prices)
+            while len(_price_cache) > PRICE_CACHE_MAXSIZE:
+                oldest = min(_price_cache, key=lambda key: _price_cache[key][0])
+                del _price_cache[oldest]
+        return prices
 
 # Function to get the current electricity price
 def get_current_price() -> Optional[float]:
     try:
         dato = get_cet_time()
-        år = dato.year
-        måned = f"{dato.month:02d}"
-        dag = f"{dato.day:02d}"
-        time = dato.hour
+        timen = dato.hour
 
-        pris_url = f"https://www.elprisetjustnu.se/api/v1/prices/{år}/{måned}-{dag}_{PRIS_KLASSE}.json"
-        logger.debug(f"Fetching price from: {pris_url}")
-        
-        respons = requests.get(pris_url, timeout=10)
-        respons.raise_for_status()
-        
-        strømpriser = respons.json()
+        strømpriser = get_day_prices((dato.year, dato.month, dato.day, CFG.klasse))
         
-        if isinstance(strømpriser, list) and len(strømpriser) > time:
-            nåværende_pris = strømpriser[time]["SEK_per_kWh"]
-            nåværende_pris = round(nåværende_pris * 100, 2)  # Convert to øre/kWh
-            logger.info(f"Current price: {nåværende_pris:.2f} øre/kWh")
-            return nåværende_pris
-        else:
-            logger.error(f"No price data for hour {time}")
+        try:
+            nåværende_pris = strømpriser[timen]["SEK_per_kWh"]
+        except (IndexError, KeyError, TypeError):
+            logger.error(f"No price data for hour {timen}")
             return None
-            
+
+        nåværende_pris = round(nåværende_pris * 100, 2)  # Convert to øre/kWh
+        logger.info(f"Current price: {nåværende_pris:.2f} øre/kWh")
+        return nåværende_pris
+
     except Exception as e:
         logger.error(f"Error fetching price: {e}")
         return None
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see deploy_aws.sh)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', port=5001)
\ No newline at end of file
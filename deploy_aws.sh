@@ -39,12 +39,26 @@ After=network.target
 User=ubuntu
 WorkingDirectory=/home/ubuntu/varmepumpe_kontroll
 Environment="PATH=/home/ubuntu/varmepumpe_kontroll/venv/bin"
-ExecStart=/home/ubuntu/varmepumpe_kontroll/venv/bin/gunicorn --workers 4 --bind 127.0.0.1:5001 app:app
+ExecStart=/home/ubuntu/varmepumpe_kontroll/venv/bin/gunicorn --workers 4 --worker-class gthread --threads 4 --preload --bind 127.0.0.1:5001 app:app
 Restart=always
 
 [Install]
 WantedBy=multi-user.target
 EOF
 
+# Rotate app.log; the app reopens the file itself after it is moved
+sudo tee /etc/logrotate.d/varmepumpe << EOF
+/home/ubuntu/varmepumpe_kontroll/app.log {
+    su ubuntu ubuntu
+    create 0644 ubuntu ubuntu
+    weekly
+    rotate 4
+    compress
+    delaycompress
+    missingok
+    notifempty
+}
+EOF
+
 sudo systemctl enable varmepumpe
 sudo systemctl start varmepumpe
\ No newline at end of file